@@ -3,7 +3,9 @@ Test code to communicate with the MakeBlock Ranger with the Firmware_for_Auriga
 '''
 
 import asyncio
+import signal
 import struct
+import sys
 from bleak import BleakClient
 
 # Constants for Actions
@@ -64,6 +66,16 @@ PORT_3 = 3
 PORT_4 = 4
 PORT_10 = 10
 
+# Packet framing
+PACKET_HEADER = b'\xff\x55'
+FLOAT_LE = struct.Struct('<f')  # Precompiled little-endian float, reused for every notification
+COMMAND_PREFIX = struct.Struct('<2sBBBB')  # header, length, idx, action, device
+
+RX_QUEUE_SIZE = 1024  # Notifications buffered between the Bleak callback and the parser
+STDOUT_FLUSH_INTERVAL = 0.25  # Seconds between flushes of the block-buffered stdout
+COMMAND_INTERVAL = 0.02  # Minimum seconds between two writes, about one connection interval
+_DEBUG = False  # Print every raw notification as hex
+
 # Replace with your MakeBlock Ranger's Bluetooth address
 DEVICE_ADDRESS = "10:A5:62:0A:24:E7"
 CHARACTERISTIC_NOTIFY_UUID = "0000ffe2-0000-1000-8000-00805f9b34fb"  # UUID for notifications
@@ -115,131 +127,227 @@ def construct_command(idx, action, device, port=None, slot=None, data=None):
         data (list or bytearray, optional): Additional data bytes. Defaults to None.
 
     Returns:
-        bytearray: The constructed command as a bytearray.
+        bytes: The constructed command as immutable bytes.
     """
-    # Start with the header
-    command = bytearray([0xFF, 0x55])
-    
-    # Calculate the length dynamically based on provided parameters
-    length = 3  # Starts with idx, action, device
-    if port is not None:
-        length += 1
-    if slot is not None:
-        length += 1
-    if data:
-        length += len(data)
-    
-    # Add length to the command
-    command.append(length)
-    
-    # Add core parameters
-    command.append(idx)
-    command.append(action)
-    command.append(device)
-
-    # Add optional port and slot if provided
-    if port is not None:
-        command.append(port)
-    if slot is not None:
-        command.append(slot)
+    # Optional port and slot, only if provided
+    optional = bytes([value for value in (port, slot) if value is not None])
+    # Additional data, if provided
+    tail = bytes(data) if data else b''
 
-    # Add additional data if provided
-    if data:
-        command.extend(data)
+    # Header, length (idx, action, device + optional fields + data) and core
+    # parameters are packed in a single call
+    length = 3 + len(optional) + len(tail)
+    return COMMAND_PREFIX.pack(PACKET_HEADER, length, idx, action, device) + optional + tail
 
-    return command
+# Commands with constant parameters are built once at import time
+LED_PURPLE = construct_command(
+    idx=1,
+    action=ACTION_RUN,
+    device=RGBLED,
+    port=0,
+    slot=1,
+    data=[10, 20, 0, 20]  # RGB values for purple
+)
 
-# Handler for incoming notifications
-def notification_handler(sender, data):
-    try:
-        # Attempt to decode data as text to detect any Serial.print messages
-        message = data.decode('utf-8').strip()
-        if message:
-            print(f"Serial message: {message}")
-            return
-    except UnicodeDecodeError:
-        # If data is not text, continue processing as usual
-        pass
+# Parser for incoming notifications, run by consume_notifications
+def parse_notification(data):
+    # Binary frames start with 0xFF 0x55, which is never valid UTF-8: skip the
+    # decode attempt (and the exception it would raise) for them
+    if not data.startswith(PACKET_HEADER):
+        try:
+            # Attempt to decode data as text to detect any Serial.print messages
+            message = data.decode('utf-8').strip()
+            if message:
+                print(f"Serial message: {message}")
+                return
+        except UnicodeDecodeError:
+            # If data is not text, continue processing as usual
+            pass
     
     # Print received data for debugging
-    print(f"Raw data received: {data.hex()}")
+    if _DEBUG:
+        print(f"Raw data received: {data.hex()}")
 
     if data == b'\xff\x55\x0d\x0a':
         print("Received callOK acknowledgment")
         
     # Check if the data starts with the expected header and contains enough bytes for a float
-    elif data[:2] == b'\xff\x55' and len(data) >= 8:
+    elif data.startswith(PACKET_HEADER) and len(data) >= 8:
         # Extract the type byte to determine the data format
         index_byte = data[2]
         data_type = data[3]
 
         if data_type == 2 or (data_type == 1 and index_byte == 1):
-            # Extract the 4 bytes that represent the float
-            float_bytes = data[4:8]
-            # Convert the bytes into a float using struct.unpack
-            distance = struct.unpack('<f', float_bytes)[0]
+            # Read the 4 bytes that represent the float straight from the packet, no slice copy
+            distance = FLOAT_LE.unpack_from(data, 4)[0]
             print(f"Received Distance: {distance:.2f} cm")
         else:
             print(f"Unexpected data type or index: index={index_byte}, type={data_type}")
     else:
         print(f"Unexpected data format: {data.hex()}")
 
+async def negotiate_mtu(client):
+    """Make sure the ATT MTU for this connection is known and return it."""
+    # BlueZ only reports the negotiated MTU after it has been acquired explicitly;
+    # the other backends negotiate it while connecting
+    if client._backend.__class__.__name__ == "BleakClientBlueZDBus":
+        try:
+            await client._backend._acquire_mtu()
+        except Exception as e:
+            print(f"Could not acquire the MTU: {e}")
+    return client.mtu_size
+
+class CmdCoalescer:
+    """Sends at most one write per interval, keeping only the newest command per key."""
+
+    def __init__(self, write, char=CHARACTERISTIC_WRITE_UUID, response=True, max_size=20, interval=COMMAND_INTERVAL):
+        self._write = write
+        self._char = char
+        self._response = response
+        self._max_size = max_size
+        self._interval = interval
+        self._pending = {}
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._pump())
+
+    def submit(self, key, command):
+        # A newer command for the same (device, port, slot) replaces the queued one
+        self._pending[key] = command
+        self._ready.set()
+
+    async def _pump(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            pending, self._pending = self._pending, {}
+            for command in pending.values():
+                # Write-without-response is never fragmented: anything larger than one
+                # ATT payload goes out as an acknowledged (long) write instead
+                response = self._response or len(command) > self._max_size
+                try:
+                    await self._write(self._char, command, response=response)
+                    print(f"Sent command: {command.hex()}")
+                except Exception as e:
+                    # A failed write (BleakError, or OSError once WinRT has closed the
+                    # link) must not kill the pump for every later command
+                    print(f"Failed to send command {command.hex()}: {e}")
+                # Leave the robot one connection interval to drain its buffer
+                await asyncio.sleep(self._interval)
+
+    def close(self):
+        self._task.cancel()
+
+async def consume_notifications(rx_queue):
+    """Parse the notifications queued by the Bleak callback, off the callback path."""
+    while True:
+        parse_notification(await rx_queue.get())
+
+async def flush_stdout_periodically():
+    """Flush stdout a few times per second instead of on every printed line."""
+    while True:
+        await asyncio.sleep(STDOUT_FLUSH_INTERVAL)
+        sys.stdout.flush()
+
 async def main():
-    async with BleakClient(DEVICE_ADDRESS) as client:
-        print(f"Connected to {DEVICE_ADDRESS}")
+    loop = asyncio.get_running_loop()
+    # Set on Ctrl+C or when the robot drops the link; nothing polls in between
+    stop = asyncio.Event()
+
+    rx_queue = asyncio.Queue(maxsize=RX_QUEUE_SIZE)
+
+    # Handler for incoming notifications: only queue the data so Bleak can get
+    # back to draining the OS buffer. Bleak hands over a fresh bytearray for each
+    # notification, so it is queued as-is rather than copied
+    def notification_handler(sender, data):
+        if rx_queue.full():
+            rx_queue.get_nowait()  # Drop the oldest notification, keep the freshest
+        rx_queue.put_nowait(data)
+
+    consumer_task = asyncio.create_task(consume_notifications(rx_queue))
+
+    # Per-notification prints would otherwise cost one write() each on a terminal
+    line_buffering = sys.stdout.line_buffering
+    sys.stdout.reconfigure(line_buffering=False)
+    flush_task = asyncio.create_task(flush_stdout_periodically())
 
-        # Subscribe to notifications
-        await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, notification_handler)
+    coalescer = None
+    # Restore stdout and stop the helper tasks even if connecting or any step below fails
+    try:
+        async with BleakClient(DEVICE_ADDRESS, disconnected_callback=lambda _client: stop.set()) as client:
+            print(f"Connected to {DEVICE_ADDRESS}")
+            # Resolve the bound write method once for every command sent below
+            write = client.write_gatt_char
+            # Write-without-response only when the characteristic advertises it
+            char = client.services.get_characteristic(CHARACTERISTIC_WRITE_UUID)
+            response = char is None or "write-without-response" not in char.properties
+
+            # Largest command that fits in a single ATT write (3 bytes of ATT header)
+            max_command_size = await negotiate_mtu(client) - 3
+            print(f"MTU: {max_command_size + 3} bytes")
+            coalescer = CmdCoalescer(write, char or CHARACTERISTIC_WRITE_UUID, response, max_command_size)
+
+            # Subscribe to notifications
+            await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, notification_handler)
         
-        # # Command to run the motor forward (index=1, action=2 for RUN, device=61 for motor, port=0, slot=1)
-        # command = construct_command(
-        #     idx=1,
-        #     action=2,  
-        #     device=61,  
-        #     port=0,    
-        #     slot=2,    
-        #     data=[12]  
-        # )
+            # # Command to run the motor forward (index=1, action=2 for RUN, device=61 for motor, port=0, slot=1)
+            # command = construct_command(
+            #     idx=1,
+            #     action=2,  
+            #     device=61,  
+            #     port=0,    
+            #     slot=2,    
+            #     data=[12]  
+            # )
         
-        # # Command to reset the Auriga
-        # reset_command = construct_command(
-        #     idx=1,
-        #     action=4,
-        #     device=61,
-        #     port=0,
-        #     slot=2
-        # )
+            # # Command to reset the Auriga
+            # reset_command = construct_command(
+            #     idx=1,
+            #     action=4,
+            #     device=61,
+            #     port=0,
+            #     slot=2
+            # )
         
-        # command = construct_command(
-        #     idx=1,
-        #     action=ACTION_GET,
-        #     device=DEVICE_ULTRASONIC_SENSOR,
-        #     port=PORT_10
-        # )
+            # command = construct_command(
+            #     idx=1,
+            #     action=ACTION_GET,
+            #     device=DEVICE_ULTRASONIC_SENSOR,
+            #     port=PORT_10
+            # )
         
-        # Command to set the RGB LED to purple        
-        command = construct_command(
-            idx=1,
-            action=2,  
-            device=8,  
-            port=0,    
-            slot=1,
-            data=[10, 20, 0, 20]  # RGB values for purple
-        )
+            # Command to set the RGB LED to purple
+            command = LED_PURPLE
 
+            if len(command) > max_command_size:
+                print(f"Warning: {len(command)}-byte command exceeds the {max_command_size}-byte payload and will be sent as a long write with response")
 
-        # Write the command to the characteristic
-        await client.write_gatt_char(CHARACTERISTIC_WRITE_UUID, command)
-        print(f"Sent command: {command.hex()}")
+            # Queue the command; the coalescer writes it without response (no ACK round trip) when supported
+            coalescer.submit((RGBLED, 0, 1), command)
+
+            try:
+                loop.add_signal_handler(signal.SIGINT, stop.set)
+            except NotImplementedError:
+                pass  # Windows: Ctrl+C still interrupts asyncio.run()
 
-        try:
             print("Waiting for notifications... (Press Ctrl+C to stop)")
-            while True:
-                # Keep the connection alive to receive notifications
-                await asyncio.sleep(1)
-        except KeyboardInterrupt:
+            # Keep the connection alive to receive notifications
+            await stop.wait()
+
             print("Disconnecting...")
-            await client.stop_notify(CHARACTERISTIC_NOTIFY_UUID)
+            if client.is_connected:
+                await client.stop_notify(CHARACTERISTIC_NOTIFY_UUID)
+    finally:
+        # Give Ctrl+C back its default KeyboardInterrupt behaviour
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except NotImplementedError:
+            pass
+        if coalescer is not None:
+            coalescer.close()
+        consumer_task.cancel()
+        flush_task.cancel()
+        sys.stdout.flush()
+        sys.stdout.reconfigure(line_buffering=line_buffering)
         
 
 # Run the main function
@@ -5,19 +5,24 @@ from bleak import BleakScanner, BleakClient
 
 # Configuration
 MAKEBLOCK_PREFIX = "Makeblock_LE"
-BEEP_COMMAND = bytearray([0xFF, 0x55, 0x39, 0x39, 0x39, 0x39])  # Example beep command (adjust if needed)
+BEEP_COMMAND = bytes([0xFF, 0x55, 0x39, 0x39, 0x39, 0x39])  # Example beep command (adjust if needed)
 WAIT_TIME = 10  # Time in seconds to wait after each beep
+MAX_CONNECTIONS = 5  # Simultaneous connections, kept under the adapter's limit
 CHARACTERISTIC_WRITE_UUID = "0000ffe3-0000-1000-8000-00805f9b34fb"  # UUID for writing
 
-async def beep_robot(address, name):
+async def beep_robot(address, name, connection_slots, beep_lock):
     """Connect to a robot, send a beep command, and wait for a response."""
-    async with BleakClient(address) as client:
-        if client.is_connected:
-            print(f"Connected to {name} ({address}). Sending beep command...")
-            await client.write_gatt_char(CHARACTERISTIC_WRITE_UUID, BEEP_COMMAND)
-            print(f"Beep sent to {name}. Waiting for {WAIT_TIME} seconds...")
-            await asyncio.sleep(WAIT_TIME)
-            print(f"Robot name: {name}, MAC address: {address}")
+    async with connection_slots:
+        # Entering the context already guarantees the connection (or raises)
+        async with BleakClient(address) as client:
+            # Connections are opened concurrently, but beeps stay one at a
+            # time so each robot can still be told apart by ear
+            async with beep_lock:
+                print(f"Connected to {name} ({address}). Sending beep command...")
+                await client.write_gatt_char(CHARACTERISTIC_WRITE_UUID, BEEP_COMMAND)
+                print(f"Beep sent to {name}. Waiting for {WAIT_TIME} seconds...")
+                await asyncio.sleep(WAIT_TIME)
+                print(f"Robot name: {name}, MAC address: {address}")
 
 async def scan_and_beep():
     """Scan for all Makeblock robots and beep each one."""
@@ -29,11 +34,16 @@ async def scan_and_beep():
         print("No Makeblock robots found.")
         return
 
-    for robot in makeblock_robots:
-        try:
-            await beep_robot(robot.address, robot.name)
-        except Exception as e:
-            print(f"Failed to beep {robot.name} ({robot.address}): {e}")
+    connection_slots = asyncio.Semaphore(MAX_CONNECTIONS)
+    beep_lock = asyncio.Lock()
+    results = await asyncio.gather(
+        *(beep_robot(robot.address, robot.name, connection_slots, beep_lock) for robot in makeblock_robots),
+        return_exceptions=True,
+    )
+
+    for robot, result in zip(makeblock_robots, results):
+        if isinstance(result, Exception):
+            print(f"Failed to beep {robot.name} ({robot.address}): {result}")
 
 async def main():
     await scan_and_beep()
@@ -1,5 +1,9 @@
 import asyncio
+import sys
+import threading
 import json
+from functools import reduce
+from operator import xor
 from bleak import BleakClient, BleakScanner, BleakError
 
 # Bluetooth Configuration
@@ -8,6 +12,10 @@ DEVICE_FILE = "last_connected_device.json"
 CHARACTERISTIC_NOTIFY_UUID = "0000ffe2-0000-1000-8000-00805f9b34fb"
 CHARACTERISTIC_WRITE_UUID = "0000ffe3-0000-1000-8000-00805f9b34fb"
 DISCONNECTION_TIMEOUT = 10
+SCAN_TIMEOUT = 5.0  # Upper bound of the device search, same as the discover() it replaced
+
+# Packet header (0xFF 0x55)
+PACKET_HEADER = b'\xff\x55'
 
 # End Data Options
 END_DATA_OPTIONS = {
@@ -16,11 +24,7 @@ END_DATA_OPTIONS = {
     'BOTH': b'\r\n',
     'NONE': b''
 }
-
-# Global variables
-is_user_input_active = False
-incomplete_message = ""
-last_received_time = None
+DEFAULT_END_DATA = END_DATA_OPTIONS['BOTH']
 
 def load_last_device():
     """Load the last connected device from a JSON file."""
@@ -38,50 +42,137 @@ def save_last_device(device_name):
 
 def calculate_crc(data):
     """Calculate CRC by XOR-ing all bytes."""
-    crc = 0
-    for byte in data:
-        crc ^= byte
-    return crc
-
-def parse_data(data):
-    """Handle and concatenate fragmented messages."""
-    global incomplete_message, last_received_time
-
-    # Update last received time
-    last_received_time = asyncio.get_event_loop().time()
-    
-    try:
-        message = data.decode('utf-8', errors='ignore')
-        incomplete_message += message
+    return reduce(xor, data, 0)
+
+# XOR is associative: the header's share of the CRC is computed once
+HEADER_CRC = calculate_crc(PACKET_HEADER)
+
+class BleSession:
+    """State of one BLE connection, kept in slots instead of module globals."""
+    __slots__ = ('buf', 'is_input_active', 'last_rx', 'loop', 'client', 'write', 'write_char', 'response', 'max_size')
+
+    def __init__(self, client, loop):
+        self.buf = bytearray()  # Raw bytes waiting for a '\n'
+        self.is_input_active = False
+        self.last_rx = loop.time()
+        self.loop = loop
+        self.client = client
+        self.write = client.write_gatt_char
+        self.resolve_write_char()
+
+    def resolve_write_char(self):
+        """Resolve the write characteristic; redo after every (re)connection."""
+        char = self.client.services.get_characteristic(CHARACTERISTIC_WRITE_UUID)
+        self.write_char = char or CHARACTERISTIC_WRITE_UUID
+        # Write-without-response only when the characteristic advertises it
+        self.response = char is None or "write-without-response" not in char.properties
+        # Write-without-response is never fragmented; read once the MTU is known
+        self.max_size = (char.max_write_without_response_size if char is not None
+                         else self.client.mtu_size - 3)
+
+    def parse_data(self, data):
+        """Handle and concatenate fragmented messages."""
+        # Update last received time
+        self.last_rx = self.loop.time()
         
-        if '\n' in incomplete_message:
-            lines = incomplete_message.split('\n')
-            for line in lines[:-1]:
-                print(f"Complete message received: {line.strip()}")
-            incomplete_message = lines[-1]
-    except UnicodeDecodeError:
-        print(f"Raw data received: {data.hex()}")
-
-async def notification_handler(sender, data):
-    """Handle incoming notifications."""
-    global is_user_input_active
-    if is_user_input_active:
-        return
-    parse_data(data)
+        try:
+            # The pending buffer never holds a '\n', so only the new chunk needs checking
+            buf = self.buf
+            buf.extend(data)
+            nl = buf.rfind(b'\n', len(buf) - len(data))
+            if nl >= 0:
+                complete = buf[:nl].decode('utf-8', errors='ignore')
+                del buf[:nl + 1]
+                for line in complete.split('\n'):
+                    print(f"Complete message received: {line.strip()}")
+        except UnicodeDecodeError:
+            print(f"Raw data received: {data.hex()}")
+
+    async def notification_handler(self, sender, data):
+        """Handle incoming notifications."""
+        if self.is_input_active:
+            return
+        self.parse_data(data)
+
+    async def send_data(self, data, end_data='BOTH'):
+        """Send data with a header and CRC."""
+        # Unknown options fall back to CR + NL in the same lookup
+        end = END_DATA_OPTIONS.get(end_data, DEFAULT_END_DATA)
+
+        # Only the payload is walked for the CRC, then the packet is joined in one pass
+        crc = HEADER_CRC ^ calculate_crc(data)
+        packet = b''.join((PACKET_HEADER, data, bytes((crc,)), end))
+
+        # Write-without-response when supported: don't wait a connection interval for the ACK
+        # Packets larger than one ATT payload go out as an acknowledged long write
+        await self.write(self.write_char, packet, response=self.response or len(packet) > self.max_size)
+        print(f"Sent: {packet.hex()}")
+
+    def start_input_reader(self):
+        """Read stdin in a dedicated thread and hand each line to the loop through a queue."""
+        lines = asyncio.Queue()
+        call_soon_threadsafe = self.loop.call_soon_threadsafe
+
+        def read_lines():
+            for line in sys.stdin:
+                call_soon_threadsafe(lines.put_nowait, line.rstrip('\n'))
+            # End of stdin: behave like 'quit'
+            call_soon_threadsafe(lines.put_nowait, 'quit')
+
+        threading.Thread(target=read_lines, daemon=True).start()
+        return lines
+
+    async def listen_for_user_input(self):
+        """Listen for user input without blocking notifications."""
+        lines = self.start_input_reader()
+
+        while True:
+            activation_input = await prompt(lines, "Type ':' and Enter to enter data (or 'quit' to exit): ")
+            
+            if activation_input.lower() == 'quit':
+                break
+
+            if activation_input == ':':
+                self.is_input_active = True
+                user_input = await prompt(lines, "Enter data to send (or 'quit' to exit): ")
+                
+                if user_input.lower() == 'quit':
+                    break
+
+                self.is_input_active = False
+                data_to_send = bytearray(user_input, 'utf-8')
+                await self.send_data(data_to_send)
+
+async def prompt(lines, message):
+    """Show a prompt and wait for the next line read from stdin."""
+    print(message, end='', flush=True)
+    return await lines.get()
+
+async def negotiate_mtu(client):
+    """Make sure the ATT MTU for this connection is known and return it."""
+    # BlueZ only reports the negotiated MTU after it has been acquired explicitly;
+    # the other backends negotiate it while connecting
+    if client._backend.__class__.__name__ == "BleakClientBlueZDBus":
+        try:
+            await client._backend._acquire_mtu()
+        except Exception as e:
+            print(f"Could not acquire the MTU: {e}")
+    return client.mtu_size
 
 async def find_device(device_name):
     """Scan and find the MakeBlock Ranger based on the provided device name."""
-    devices = await BleakScanner.discover()
-    for device in devices:
-        if device.name == device_name:
-            print(f"Device found: {device.name}, Address: {device.address}")
-            return device.address
+    # Returns as soon as the device advertises instead of after a full discover()
+    device = await BleakScanner.find_device_by_name(device_name, timeout=SCAN_TIMEOUT)
+    if device:
+        print(f"Device found: {device.name}, Address: {device.address}")
+        return device.address
 
     print("Device not found.")
     return None
 
-async def handle_disconnect(client: BleakClient):
+async def handle_disconnect(session: BleSession):
     """Handle the peripheral disconnection and attempt to reconnect."""
+    client = session.client
     print("Peripheral device disconnected unexpectedly.")
     attempt = 1
     max_attempts = 5
@@ -93,7 +184,9 @@ async def handle_disconnect(client: BleakClient):
             await asyncio.wait_for(client.connect(), timeout=reconnect_timeout)
             if client.is_connected:
                 print("Reconnected successfully.")
-                await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, notification_handler)
+                await negotiate_mtu(client)
+                session.resolve_write_char()
+                await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, session.notification_handler)
                 break
         except asyncio.TimeoutError:
             print(f"Reconnection attempt {attempt} timed out.")
@@ -103,42 +196,9 @@ async def handle_disconnect(client: BleakClient):
     if not client.is_connected:
         print("Failed to reconnect after several attempts.")
 
-async def send_data(client, data, end_data='BOTH'):
-    """Send data with a header and CRC."""
-    if end_data not in END_DATA_OPTIONS:
-        end_data = 'BOTH'
-    
-    packet = bytearray([0xFF, 0x55])
-    packet.extend(data)
-    crc = calculate_crc(packet)
-    packet.append(crc)
-    packet.extend(END_DATA_OPTIONS[end_data])
-
-    await client.write_gatt_char(CHARACTERISTIC_WRITE_UUID, packet)
-    print(f"Sent: {packet.hex()}")
-
-async def listen_for_user_input(client):
-    """Listen for user input without blocking notifications."""
-    global is_user_input_active
-
-    while True:
-        activation_input = await asyncio.get_event_loop().run_in_executor(None, input, "Type ':' and Enter to enter data (or 'quit' to exit): ")
-        
-        if activation_input.lower() == 'quit':
-            break
-
-        if activation_input == ':':
-            is_user_input_active = True
-            user_input = await asyncio.get_event_loop().run_in_executor(None, input, "Enter data to send (or 'quit' to exit): ")
-            
-            if user_input.lower() == 'quit':
-                break
-
-            is_user_input_active = False
-            data_to_send = bytearray(user_input, 'utf-8')
-            await send_data(client, data_to_send)
-
 async def main():
+    loop = asyncio.get_running_loop()
+
     print("Type ':' to activate user input.")
     
     device_name = load_last_device()
@@ -159,12 +219,13 @@ async def main():
         async with BleakClient(device_address, timeout=30.0) as client:
             print(f"Connecté à {device_address}")
             
-            global last_received_time
-            last_received_time = asyncio.get_event_loop().time()
+            mtu = await negotiate_mtu(client)
+            print(f"MTU: {mtu} bytes")
+            session = BleSession(client, loop)
 
-            await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, notification_handler)
+            await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, session.notification_handler)
 
-            user_input_task = asyncio.create_task(listen_for_user_input(client))
+            user_input_task = asyncio.create_task(session.listen_for_user_input())
             await user_input_task
 
     except BleakError as e:
@@ -1,8 +1,11 @@
 import asyncio
 import struct
 import sys
+import threading
 import platform
 import json
+from functools import reduce
+from operator import xor
 from bleak import BleakClient, BleakScanner, BleakError
 
 # Configuration Bluetooth
@@ -14,6 +17,10 @@ CHARACTERISTIC_WRITE_UUID = "0000ffe3-0000-1000-8000-00805f9b34fb"  # UUID for w
 CHARACTERISTIC_READ_UUID = "0000ffe5-0000-1000-8000-00805f9b34fb"  # Example for read characteristic
 CHARACTERISTIC_INDICATE_UUID = "0000ffe4-0000-1000-8000-00805f9b34fb"  # Example for indication characteristic
 DISCONNECTION_TIMEOUT = 10
+SCAN_TIMEOUT = 5.0  # Upper bound of the device search, same as the discover() it replaced
+
+# En-tête de trame (0xFF 0x55)
+PACKET_HEADER = b'\xff\x55'
 
 # Options de données de fin
 END_DATA_OPTIONS = {
@@ -22,11 +29,7 @@ END_DATA_OPTIONS = {
     'BOTH': b'\r\n',  # CR + NL
     'NONE': b''  # Pas de données de fin
 }
-
-# Global variables
-is_user_input_active = False
-incomplete_message = ""
-last_received_time = None
+DEFAULT_END_DATA = END_DATA_OPTIONS['BOTH']
 
 def load_last_device():
     """Load the last connected device name from a JSON file."""
@@ -44,62 +47,162 @@ def save_last_device(device_name):
 
 def calculate_crc(data):
     """Calcule le CRC en effectuant un XOR de tous les octets."""
-    crc = 0
-    for byte in data:
-        crc ^= byte
-    return crc
-
-def parse_data(data):
-    """Handle and concatenate fragmented messages."""
-    global incomplete_message
-
-    try:
-        # Update the last received time to the current time when data is received
-        last_received_time = asyncio.get_event_loop().time()
-        
-        # Decode the received data to string
-        message = data.decode('utf-8', errors='ignore')
-        incomplete_message += message
-        
-        # Look for complete messages that end with a newline character
-        if '\n' in incomplete_message:
-            # Split the message on newline to get complete chunks
-            lines = incomplete_message.split('\n')
+    return reduce(xor, data, 0)
+
+# Le XOR est associatif : la part de l'en-tête est calculée une seule fois
+HEADER_CRC = calculate_crc(PACKET_HEADER)
+
+class BleSession:
+    """État d'une connexion BLE, dans des slots plutôt que des variables globales."""
+    __slots__ = ('buf', 'is_input_active', 'last_rx', 'loop', 'client', 'write', 'write_char', 'response', 'max_size')
+
+    def __init__(self, client, loop):
+        self.buf = bytearray()  # Octets reçus en attente d'un '\n'
+        self.is_input_active = False
+        self.last_rx = loop.time()
+        self.loop = loop
+        self.client = client
+        self.write = client.write_gatt_char
+        self.resolve_write_char()
+
+    def resolve_write_char(self):
+        """Résoudre la caractéristique d'écriture ; à refaire après chaque (re)connexion."""
+        char = self.client.services.get_characteristic(CHARACTERISTIC_WRITE_UUID)
+        self.write_char = char or CHARACTERISTIC_WRITE_UUID
+        # Write-without-response only when the characteristic advertises it
+        self.response = char is None or "write-without-response" not in char.properties
+        # Write-without-response is never fragmented; read once the MTU is known
+        self.max_size = (char.max_write_without_response_size if char is not None
+                         else self.client.mtu_size - 3)
+
+    def parse_data(self, data):
+        """Handle and concatenate fragmented messages."""
+        try:
+            # Update the last received time to the current time when data is received
+            self.last_rx = self.loop.time()
             
-            # Process all but the last (possibly incomplete) part
-            for line in lines[:-1]:
+            # Append the raw bytes; only the new chunk needs to be searched for a newline
+            buf = self.buf
+            start = 0
+            buf.extend(data)
+            end = buf.find(b'\n', len(buf) - len(data))
+
+            # Decode and process each complete message that ends with a newline character
+            while end >= 0:
+                line = buf[start:end].decode('utf-8', errors='ignore')
                 #print(f"Message série complet : {line.strip()}")
                 print(f"{line.strip()}")
-            
+                start = end + 1
+                end = buf.find(b'\n', start)
+
             # Keep the last segment as incomplete if it doesn't end with a newline
-            incomplete_message = lines[-1]
-    except UnicodeDecodeError:
-        print(f"Données brutes reçues : {data.hex()}")
+            if start:
+                del buf[:start]
+        except UnicodeDecodeError:
+            print(f"Données brutes reçues : {data.hex()}")
+
+    async def notification_handler(self, sender, data):
+        """Gère les notifications entrantes en envoyant les données à parseData."""
+        if self.is_input_active:
+            return  # Skip handling if user input is active
+      
+        self.parse_data(data)
+
+    async def check_disconnection(self):
+        """Check for disconnection based on data reception time."""
+        while True:
+            # Sleep until the current deadline instead of waking up every second
+            remaining = self.last_rx + DISCONNECTION_TIMEOUT - self.loop.time()
+            if remaining <= 0:
+                print(f"No data received for {DISCONNECTION_TIMEOUT} seconds. Disconnecting...")
+                await self.client.disconnect()
+                break
+            await asyncio.sleep(remaining)
 
+    async def send_data(self, data, end_data='BOTH'):
+        """Envoie des données au robot avec un en-tête et un CRC."""
+        # Unknown options fall back to CR + NL in the same lookup
+        end = END_DATA_OPTIONS.get(end_data, DEFAULT_END_DATA)
+
+        # Only the payload is walked for the CRC, then the packet is joined in one pass
+        crc = HEADER_CRC ^ calculate_crc(data)
+        packet = b''.join((PACKET_HEADER, data, bytes((crc,)), end))
+
+        # Write-without-response when supported: don't wait a connection interval for the ACK
+        # Packets larger than one ATT payload go out as an acknowledged long write
+        await self.write(self.write_char, packet, response=self.response or len(packet) > self.max_size)
+        print(f"Envoyé : {packet.hex()}")
+
+    def start_input_reader(self):
+        """Lire stdin dans un thread dédié et transmettre chaque ligne à la boucle via une file."""
+        lines = asyncio.Queue()
+        call_soon_threadsafe = self.loop.call_soon_threadsafe
+
+        def read_lines():
+            for line in sys.stdin:
+                call_soon_threadsafe(lines.put_nowait, line.rstrip('\n'))
+            # Fin de stdin : se comporter comme 'quit'
+            call_soon_threadsafe(lines.put_nowait, 'quit')
+
+        threading.Thread(target=read_lines, daemon=True).start()
+        return lines
+
+    async def listen_for_user_input(self):
+        """Écouter les entrées utilisateur sans bloquer la réception des notifications."""
+        lines = self.start_input_reader()
+
+        while True:
+            # Prompt the user to activate input mode
+            activation_input = await prompt(lines, "Tapez ':' puis Entrée pour entrer des données (ou 'quit' pour quitter) :\n")
+            
+            if activation_input.lower() == 'quit':
+                break
 
+            if activation_input == ':':
+                self.is_input_active = True
 
-async def notification_handler(sender, data):
-    """Gère les notifications entrantes en envoyant les données à parseData."""
-    global is_user_input_active
+                # Demander l'entrée de l'utilisateur
+                user_input = await prompt(lines, "Entrez des données à envoyer (ou 'quit' pour quitter) : ")
+                
+                if user_input.lower() == 'quit':
+                    break
 
-    if is_user_input_active:
-        return  # Skip handling if user input is active
-  
-    parse_data(data)
+                self.is_input_active = False
+
+                # Envoyer les données saisies par l'utilisateur au robot
+                data_to_send = bytearray(user_input, 'utf-8')
+                await self.send_data(data_to_send)
+
+async def prompt(lines, message):
+    """Afficher une invite et attendre la prochaine ligne lue sur stdin."""
+    print(message, end='', flush=True)
+    return await lines.get()
+
+async def negotiate_mtu(client):
+    """Connaître le MTU ATT de cette connexion et le renvoyer."""
+    # BlueZ only reports the negotiated MTU after it has been acquired explicitly;
+    # the other backends negotiate it while connecting
+    if client._backend.__class__.__name__ == "BleakClientBlueZDBus":
+        try:
+            await client._backend._acquire_mtu()
+        except Exception as e:
+            print(f"Could not acquire the MTU: {e}")
+    return client.mtu_size
 
 async def find_device(device_name):
     """Scan and find the MakeBlock Ranger based on the provided device name."""
-    devices = await BleakScanner.discover()
-    for device in devices:
-        if device.name == device_name:
-            print(f"Device found: {device.name}, Address: {device.address}")
-            return device.address
+    # Returns as soon as the device advertises instead of after a full discover()
+    device = await BleakScanner.find_device_by_name(device_name, timeout=SCAN_TIMEOUT)
+    if device:
+        print(f"Device found: {device.name}, Address: {device.address}")
+        return device.address
 
     print("Device not found.")
     return None
 
-async def handle_disconnect(client: BleakClient):
+async def handle_disconnect(session: BleSession):
     """Handle the peripheral disconnection and attempt to reconnect."""
+    client = session.client
     print("Peripheral device disconnected unexpectedly.")
     #FIXME : Doesn't reconnect
     attempt = 1
@@ -115,7 +218,9 @@ async def handle_disconnect(client: BleakClient):
             if client.is_connected:
                 print("Reconnected successfully.")
                 connected = True
-                await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, notification_handler)
+                await negotiate_mtu(client)
+                session.resolve_write_char()
+                await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, session.notification_handler)
                 break
         except asyncio.TimeoutError:
             print(f"Reconnection attempt {attempt} timed out.")
@@ -130,81 +235,14 @@ async def handle_disconnect(client: BleakClient):
     if not connected:
         print("Failed to reconnect after several attempts. Exiting...")
 
-async def check_connection(client: BleakClient):
-    """Periodically check the connection status."""
-    try:
-        while True:
-            await asyncio.sleep(5)
-            if not client.is_connected:
-                raise BleakError("Device disconnected")
-    except BleakError:
-        await handle_disconnect(client)
-
-
-async def check_connection(client: BleakClient):
-    """Periodically check the connection status."""
-    try:
-        while True:
-            # Attempt a simple read or write operation to verify connection
-            await asyncio.sleep(5)  # Check every 5 seconds
-            if not client.is_connected:
-                raise BleakError("Device disconnected")
-    except BleakError:
-        await handle_disconnect(client)
-
-async def check_disconnection(client):
-    """Periodically check for disconnection based on data reception time."""
-    global last_received_time
-
-    while True:
-        await asyncio.sleep(1)
-        
-        if last_received_time and (asyncio.get_event_loop().time() - last_received_time) > DISCONNECTION_TIMEOUT:
-            print(f"No data received for {DISCONNECTION_TIMEOUT} seconds. Disconnecting...")
-            await client.disconnect()
-            break
-
-async def send_data(client, data, end_data='BOTH'):
-    """Envoie des données au robot avec un en-tête et un CRC."""
-    if end_data not in END_DATA_OPTIONS:
-        end_data = 'BOTH'
-    
-    packet = bytearray([0xFF, 0x55])
-    packet.extend(data)
-    crc = calculate_crc(packet)
-    packet.append(crc)
-    packet.extend(END_DATA_OPTIONS[end_data])
-
-    await client.write_gatt_char(CHARACTERISTIC_WRITE_UUID, packet)
-    print(f"Envoyé : {packet.hex()}")
-
-async def listen_for_user_input(client):
-    """Écouter les entrées utilisateur sans bloquer la réception des notifications."""
-    global is_user_input_active
-
-    while True:
-        # Prompt the user to activate input mode
-        activation_input = await asyncio.get_event_loop().run_in_executor(None, input, "Tapez ':' puis Entrée pour entrer des données (ou 'quit' pour quitter) :\n")
-        
-        if activation_input.lower() == 'quit':
-            break
-
-        if activation_input == ':':
-            is_user_input_active = True
-
-            # Demander l'entrée de l'utilisateur
-            user_input = await asyncio.get_event_loop().run_in_executor(None, input, "Entrez des données à envoyer (ou 'quit' pour quitter) : ")
-            
-            if user_input.lower() == 'quit':
-                break
-
-            is_user_input_active = False
-
-            # Envoyer les données saisies par l'utilisateur au robot
-            data_to_send = bytearray(user_input, 'utf-8')
-            await send_data(client, data_to_send)
+async def check_connection(session: BleSession, disconnected: asyncio.Event):
+    """Wait for the disconnection event instead of polling the connection status."""
+    await disconnected.wait()
+    await handle_disconnect(session)
 
 async def main():
+    loop = asyncio.get_running_loop()
+
     print("Tapez ':' pour activer l'entrée utilisateur.")
     
     device_name = load_last_device()
@@ -222,23 +260,31 @@ async def main():
     save_last_device(device_name)
 
 
+    # Set by Bleak as soon as the link drops, so nothing has to poll is_connected
+    disconnected = asyncio.Event()
+
     try:
-        async with BleakClient(device_address, timeout=30.0) as client:
+        async with BleakClient(device_address, timeout=30.0,
+                               disconnected_callback=lambda _client: disconnected.set()) as client:
             print(f"Connecté à {device_address}")
             
-            global last_received_time
-            last_received_time = asyncio.get_event_loop().time()
+            mtu = await negotiate_mtu(client)
+            print(f"MTU: {mtu} bytes")
+            session = BleSession(client, loop)
 
-            await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, notification_handler)
+            await client.start_notify(CHARACTERISTIC_NOTIFY_UUID, session.notification_handler)
 
             # Créer une tâche pour vérifier la connexion
-            user_input_task = asyncio.create_task(listen_for_user_input(client))
+            user_input_task = asyncio.create_task(session.listen_for_user_input())
 
-            connection_check_task = asyncio.create_task(check_connection(client))
+            connection_check_task = asyncio.create_task(check_connection(session, disconnected))
 
             # Garder la connexion active en attendant les notifications et la déconnexion
             await user_input_task
 
+            # Déconnexion volontaire : ne pas tenter de se reconnecter
+            connection_check_task.cancel()
+
     except BleakError as e:
         print(f"An error occurred: {str(e)}")
     except KeyboardInterrupt:
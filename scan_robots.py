@@ -3,72 +3,121 @@ import asyncio
 import csv
 import os
 import platform
+import re
 
-async def scan_devices():
-    devices = await BleakScanner.discover()
-    device_dict = {device.name: device.address for device in devices if device.name}
+# The platform can't change while running, check it once
+IS_DARWIN = platform.system() == 'Darwin'
+
+# Robot name prefixes
+MAKEBLOCK_PREFIX = "Makeblock"
+MAKEBLOCK_LE_PREFIX = "Makeblock_LE"
+MAKEBLOCK_LE_PREFIX_LEN = len(MAKEBLOCK_LE_PREFIX)
+
+# Pairs of characters of the MAC embedded in a robot name (a trailing odd one is kept)
+MAC_PAIRS = re.compile(r'..?')
+
+SCAN_TIMEOUT = 5.0  # Seconds spent listening for advertisements, same as discover()
+
+async def scan_devices(timeout=SCAN_TIMEOUT):
+    device_dict = {}
+
+    # Report each device as soon as it advertises instead of after the whole scan
+    def detection_callback(device, advertisement_data):
+        if device.name and device.name not in device_dict:
+            print(f"Discovered: {device.name} ({device.address})")
+            device_dict[device.name] = device.address
+
+    async with BleakScanner(detection_callback=detection_callback):
+        await asyncio.sleep(timeout)
     return device_dict
 
 def filter_makeblock_devices(device_dict):
-    return {name: address for name, address in device_dict.items() if name.startswith("Makeblock")}
+    return {name: address for name, address in device_dict.items() if name.startswith(MAKEBLOCK_PREFIX)}
 
 def get_mac_address_from_name(robot_name):
     """Extracts and returns the MAC address from the given robot name."""
-    if robot_name.startswith("Makeblock_LE"):
+    if robot_name.startswith(MAKEBLOCK_LE_PREFIX):
         # Extract the MAC address part after 'Makeblock_LE' and insert colons
-        embedded_mac = robot_name[len("Makeblock_LE"):]
+        embedded_mac = robot_name[MAKEBLOCK_LE_PREFIX_LEN:]
         # Format MAC address as 'XX:XX:XX:XX:XX:XX'
-        mac_address = ':'.join(embedded_mac[i:i+2] for i in range(0, len(embedded_mac), 2))
+        mac_address = ':'.join(MAC_PAIRS.findall(embedded_mac))
         return mac_address
     return None
 
+CSV_HEADER = ['name', 'mac_address', 'macos_id', 'id']
+CSV_BUFFER_SIZE = 1 << 20  # 1 MiB, so a whole robot list is read or written in a few syscalls
+
 def save_robots_to_csv(robot_dict, file_name="makeblock_robots.csv"):
-    file_exists = os.path.isfile(file_name)
-    
     # Read existing robots into a dictionary for easier updating
     existing_robots = {}
-    if file_exists:
-        with open(file_name, mode='r', newline='') as file:
+    # Set when a row already in the file has to be rewritten
+    changed = False
+    # Open directly instead of checking for the file first: one syscall, no race
+    try:
+        file = open(file_name, mode='r', newline='', buffering=CSV_BUFFER_SIZE)
+    except FileNotFoundError:
+        file_exists = False
+    else:
+        file_exists = True
+        with file:
             reader = csv.reader(file)
             next(reader)  # Skip the header
             for row in reader:
                 name, mac_address, macos_id, robot_id = row
                 if mac_address == "":
-                    mac_address = get_mac_address_from_name(name)
+                    mac_address = get_mac_address_from_name(name) or ""
+                    changed = changed or bool(mac_address)
                 
                 existing_robots[name] = {
+                    "name": name,
                     "mac_address": mac_address,
                     "macos_id": macos_id,
                     "id": robot_id
                 }
 
-    # Update or add robots to the CSV file
-    with open(file_name, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['name', 'mac_address', 'macos_id', 'id'])  # Write header
-
-        # Merge new robots with existing ones
-        for name, address in robot_dict.items():
-            if name in existing_robots:
-                # Update `mac_address` or `macos_id` only if missing or different
-                if platform.system() == 'Darwin':
-                    existing_robots[name]['macos_id'] = address
-                    # If `mac_address` is missing, extract it from the name
-                    if not existing_robots[name]['mac_address']:
-                        existing_robots[name]['mac_address'] = get_mac_address_from_name(name)
-                else:
-                    existing_robots[name]['mac_address'] = address
+    # Merge new robots with existing ones
+    new_names = []
+    for name, address in robot_dict.items():
+        if name in existing_robots:
+            robot = existing_robots[name]
+            # Update `mac_address` or `macos_id` only if missing or different
+            if IS_DARWIN:
+                updated = dict(robot, macos_id=address)
+                # If `mac_address` is missing, extract it from the name
+                if not updated['mac_address']:
+                    updated['mac_address'] = get_mac_address_from_name(name) or ""
+            else:
+                updated = dict(robot, mac_address=address)
+
+            if updated != robot:
+                existing_robots[name] = updated
+                changed = True
+        else:
+            # Add new robots based on platform
+            if IS_DARWIN:
+                mac_address = get_mac_address_from_name(name)
+                existing_robots[name] = {"name": name, "mac_address": mac_address, "macos_id": address, "id": ""}
             else:
-                # Add new robots based on platform
-                if platform.system() == 'Darwin':
-                    mac_address = get_mac_address_from_name(name)
-                    existing_robots[name] = {"mac_address": mac_address, "macos_id": address, "id": ""}
-                else:
-                    existing_robots[name] = {"mac_address": address, "macos_id": "", "id": ""}
-
-        # Write all entries to the CSV file
-        for name, info in existing_robots.items():
-            writer.writerow([name, info["mac_address"], info["macos_id"], info["id"]])
+                existing_robots[name] = {"name": name, "mac_address": address, "macos_id": "", "id": ""}
+            new_names.append(name)
+
+    if file_exists and not changed:
+        if new_names:
+            # Only new robots: append their rows, the existing ones are untouched
+            with open(file_name, mode='a', newline='', buffering=CSV_BUFFER_SIZE) as file:
+                writer = csv.DictWriter(file, fieldnames=CSV_HEADER)
+                writer.writerows([existing_robots[name] for name in new_names])
+        return
+
+    # Rewrite the whole file through a temporary file so a crash never leaves it torn
+    tmp_file = file_name + ".tmp"
+    with open(tmp_file, mode='w', newline='', buffering=CSV_BUFFER_SIZE) as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_HEADER)
+        writer.writeheader()  # Write header
+
+        # Write all entries to the CSV file, each row is already keyed by column
+        writer.writerows(existing_robots.values())
+    os.replace(tmp_file, file_name)
 
 
 async def main():
@@ -2,25 +2,43 @@ import tkinter as tk
 from tkinter import ttk
 import json
 import os
+from pathlib import Path
 from bleak import BleakClient, BleakScanner, BleakError
 import asyncio
+import threading
 from concurrent.futures import ThreadPoolExecutor
+import time
+from collections import deque
+from types import MappingProxyType
+
+try:
+    import uvloop  # Optional, faster event loop (not available on Windows)
+except ImportError:
+    uvloop = None
 
 DEVICE_NAME_KEY = "device_name"
+DEVICE_ADDRESS_KEY = "device_address"
 DEVICE_FILE = "last_connected_device.json"
 CHARACTERISTIC_NOTIFY_UUID = "0000ffe2-0000-1000-8000-00805f9b34fb"  # UUID for notifications
 CHARACTERISTIC_WRITE_UUID = "0000ffe3-0000-1000-8000-00805f9b34fb"  # UUID for writing
 CHARACTERISTIC_READ_UUID = "0000ffe5-0000-1000-8000-00805f9b34fb"  # Example for read characteristic
 CHARACTERISTIC_INDICATE_UUID = "0000ffe4-0000-1000-8000-00805f9b34fb"  # Example for indication characteristic
 DISCONNECTION_TIMEOUT = 10
+FLUSH_INTERVAL_MS = 33  # Period of the Tk-side poll, at most ~30 redraws per second
+MAX_LINES = 10000  # Lines kept in the received data area, older ones are dropped
+SHUTDOWN_TIMEOUT = 2.0  # Seconds the window waits for the device to disconnect on close
+SCAN_CACHE_TTL = 30.0  # Seconds a scanned name -> address pair is trusted without rescanning
+DEFAULT_WWR_SIZE = 20  # Write-without-response payload at the default 23-byte ATT MTU
+RX_PARTIAL_TIMEOUT = 0.5  # Seconds after which a line still missing its '\n' is shown anyway
+RX_PARTIAL_MAX = 4096  # Bytes of a line still missing its '\n' after which it is shown anyway
 
-# Options de données de fin
-END_DATA_OPTIONS = {
+# Options de données de fin (lecture seule)
+END_DATA_OPTIONS = MappingProxyType({
     'NL': b'\n',  # Nouvelle ligne (0x0A)
     'CR': b'\r',  # Retour chariot (0x0D)
     'BOTH': b'\r\n',  # CR + NL
     'NONE': b''  # Pas de données de fin
-}
+})
 
 class PlaceholderEntry(tk.Entry):
     def __init__(self, master=None, placeholder="PLACEHOLDER", color='grey', **kwargs):
@@ -29,6 +47,8 @@ class PlaceholderEntry(tk.Entry):
         self.default = placeholder
         self.placeholder_color = color
         self.default_color = self['fg']
+        # Tracked in Python so focus events don't read the colour back from Tk
+        self._is_placeholder = False
 
         self.bind("<FocusIn>", self.foc_in)
         self.bind("<FocusOut>", self.foc_out)
@@ -39,11 +59,13 @@ class PlaceholderEntry(tk.Entry):
         self.delete(0, 'end')
         self.insert(0, self.default)
         self['fg'] = self.placeholder_color
+        self._is_placeholder = True
 
     def foc_in(self, *args):
-        if self['fg'] == self.placeholder_color:
+        if self._is_placeholder:
             self.delete('0', 'end')
             self['fg'] = self.default_color
+            self._is_placeholder = False
 
     def foc_out(self, *args):
         if not self.get():
@@ -54,6 +76,7 @@ class PlaceholderEntry(tk.Entry):
         self.delete(0, 'end')
         self.insert(0, text)
         self['fg'] = self.default_color
+        self._is_placeholder = False
 
 class Application(tk.Tk):
     def __init__(self):
@@ -62,14 +85,50 @@ class Application(tk.Tk):
         self.title("BLE Communication App")
         self.geometry("600x400")
         
-        self.executor = ThreadPoolExecutor(max_workers=1)
-        self.loop = asyncio.get_event_loop()
+        # The BLE event loop runs forever in a daemon thread so closing the
+        # window never waits on it
+        self.loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+        self.start_asyncio_thread()
+
+        # All writes go through one long-lived task draining a queue
+        self.ble_client = None
+        self._tx_queue = None
+        # Kept up to date by the connect path and Bleak's disconnected callback
+        self._is_connected = False
+        # Resolved from the write characteristic after each connect
+        self._write_char = CHARACTERISTIC_WRITE_UUID
+        self._supports_wwr = False
+        self._wwr_limit = DEFAULT_WWR_SIZE
+        self._call_soon_threadsafe = self.loop.call_soon_threadsafe
+        self._call_soon_threadsafe(self._start_tx_worker)
+
+        # Names and addresses seen by the last scan, only used on the asyncio thread
+        self._scan_cache = {}
+        self._scan_cache_ts = 0.0
+
+        # Device name and address currently stored in DEVICE_FILE
+        self._last_saved = None
+        self._last_address = None
+
+        # Text waiting to be inserted in the received data area
+        self._pending_text = deque()
+        # Raw notification bytes, decoded once per flush; the partial last line
+        # is carried over to the next flush
+        self._pending_rx = deque()
+        self._rx_partial = b''
+        self._rx_last = 0.0  # monotonic time of the last notification drained by _flush_text
+        # Set once the window is being destroyed, checked instead of asking Tk
+        self._closed = False
 
         # Create the controls
         self.create_controls()
+
+        # The asyncio thread only appends to the deques above; Tk is only ever
+        # touched from this periodic callback on the Tk thread
+        self._flush_job = self.after(FLUSH_INTERVAL_MS, self._poll_pending_text)
         
-        # Load the last connected device name if available
-        self.load_last_connected_device()
+        # Load the last connected device name if available, once the window is up
+        self.after_idle(self.load_last_connected_device)
     
     def create_controls(self):
         # Create a frame to hold the controls
@@ -97,104 +156,313 @@ class Application(tk.Tk):
         # Create the drop down list for line endings
         self.line_endings = tk.StringVar()
         self.line_endings.set("BOTH")  # default value
-        line_endings_options = ["NL", "CR", "BOTH", "NONE"]
+        # Options come from the mapping so the two can never drift apart
+        line_endings_options = list(END_DATA_OPTIONS)
         self.line_endings_dropdown = ttk.Combobox(message_frame, textvariable=self.line_endings, values=line_endings_options)
         self.line_endings_dropdown.pack(side=tk.LEFT)
 
+        # Keep the encoded suffix in sync with the selection so a send is one concatenation
+        self._end_bytes = END_DATA_OPTIONS[self.line_endings.get()]
+        self.line_endings.trace_add('write', self.update_end_bytes)
+
         # Create the send button
         self.send_button = tk.Button(message_frame, text="Send", command=self.send_message)
         self.send_button.pack(side=tk.LEFT)
 
         # Create the text area for received data
-        self.received_data_text = tk.Text(self)
+        # Read-only for the user, only _flush_text unlocks it to append
+        self.received_data_text = tk.Text(self, state=tk.DISABLED)
         self.received_data_text.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
+    def start_asyncio_thread(self):
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            # Only the device-file writes go through to_thread, a couple of workers is plenty
+            self.loop.set_default_executor(ThreadPoolExecutor(max_workers=2, thread_name_prefix="ble-io"))
+            self.loop.run_forever()
+
+        self.asyncio_thread = threading.Thread(target=run_loop, daemon=True)
+        self.asyncio_thread.start()
+
+    def schedule(self, coro):
+        # Fire-and-forget: no concurrent Future is created since nothing waits on the result
+        self._call_soon_threadsafe(asyncio.ensure_future, coro)
+
+    def _start_tx_worker(self):
+        # Runs on the asyncio thread so the queue belongs to self.loop
+        self._tx_queue = asyncio.Queue()
+        self._tx_task = self.loop.create_task(self._tx_worker())
+
+    async def _tx_worker(self):
+        get = self._tx_queue.get
+        while True:
+            payload = await get()
+            if not self._is_connected:
+                continue
+            client = self.ble_client
+            try:
+                # Write-without-response when the robot allows it: no ACK round trip.
+                # It is never fragmented, so larger payloads go out as a long write
+                response = not self._supports_wwr or len(payload) > self._wwr_limit
+                await client.write_gatt_char(self._write_char, payload, response=response)
+            except Exception as e:
+                # Any failure (BleakError, OSError, a client torn down mid-write...)
+                # is reported and the worker keeps serving the queue
+                self.safe_update_text(f"Failed to send: {e}\n")
+
+    def _put_tx(self, payload):
+        self._tx_queue.put_nowait(payload)
+
+    def _enqueue_tx(self, payload):
+        # One threadsafe callback per send, no coroutine or Future allocated
+        self._call_soon_threadsafe(self._put_tx, payload)
+
     def start_connect_device(self):
-        # Run the asynchronous BLE connection in a separate thread
+        # Run the asynchronous BLE connection on the asyncio thread
+        if self.device_name_entry._is_placeholder:
+            self.safe_update_text("Enter a device name first.\n")
+            return
         device_name = self.device_name_entry.get()
-        self.executor.submit(self.loop.run_until_complete, self.connect_device(device_name))
+        self.schedule(self.async_connect_device(device_name))
         
+    def safe_update_text(self, text):
+        """Queue text for the received data area; safe to call from the asyncio thread."""
+        self._pending_text.append(text)
+
+    def _poll_pending_text(self):
+        self._flush_text()
+        # Stop polling once the window is closing, so no callback outlives destroy()
+        if not self._closed:
+            self._flush_job = self.after(FLUSH_INTERVAL_MS, self._poll_pending_text)
+
+    def _flush_text(self):
+        pending = self._pending_text
+        joined = ''.join([pending.popleft() for _ in range(len(pending))])
+
+        pending_rx = self._pending_rx
+        if pending_rx:
+            raw = self._rx_partial + b''.join([pending_rx.popleft() for _ in range(len(pending_rx))])
+            self._rx_last = time.monotonic()
+            # Only complete lines are shown, decoded in a single call
+            nl = raw.rfind(b'\n') + 1
+            self._rx_partial = raw[nl:]
+            if nl:
+                # Split on '\n' only (CR LF counts as one); a lone '\r' stays in its line
+                text = raw[:nl].decode('utf-8', errors='replace').replace('\r\n', '\n')
+                joined += ''.join([f"Received: {line}\n" for line in text[:-1].split('\n')])
+            # Bounded so a robot that never sends '\n' can't grow (and recopy) it forever
+            flush_partial = len(self._rx_partial) > RX_PARTIAL_MAX
+        else:
+            flush_partial = self._rx_partial and time.monotonic() - self._rx_last > RX_PARTIAL_TIMEOUT
+        if flush_partial:
+            # Too old or too long without its '\n': show it rather than holding it
+            joined += f"Received: {self._rx_partial.decode('utf-8', errors='replace')}\n"
+            self._rx_partial = b''
+
+        if not joined:
+            return
+
+        text_widget = self.received_data_text
+        # Skip the scroll when the user has scrolled up to read the history
+        at_bottom = text_widget.yview()[1] >= 0.999
+        text_widget.configure(state=tk.NORMAL)
+        text_widget.insert(tk.END, joined)
+
+        # Bound the widget so redraws and memory don't grow with the session length
+        excess = int(text_widget.index('end-1c').split('.')[0]) - MAX_LINES
+        if excess > 0:
+            text_widget.delete('1.0', f'{excess + 1}.0')
+        text_widget.configure(state=tk.DISABLED)
+
+        if at_bottom:
+            text_widget.see(tk.END)
+
     def load_last_connected_device(self):
         try:
-            # Check if 'last_connected_device.json' exists
-            if not os.path.exists("last_connected_device.json"):
-                print("No last connected device found.")
-                return
-            
-            with open("last_connected_device.json", 'r') as f:
-                data = json.load(f)
-                last_device_name = data.get("device_name", "")
-                self.device_name_entry.set_text(last_device_name)
+            # One read of the whole file, parsed from bytes without a text wrapper
+            data = json.loads(Path(DEVICE_FILE).read_bytes())
         except FileNotFoundError:
-            pass
+            print("No last connected device found.")
+            return
+        except json.JSONDecodeError:
+            return
+
+        last_device_name = data.get(DEVICE_NAME_KEY, "")
+        self._last_saved = last_device_name
+        self._last_address = data.get(DEVICE_ADDRESS_KEY)
+        self.device_name_entry.set_text(last_device_name)
+
+    async def find_device(self, device_name, timeout=5.0):
+        # A recent scan already saw this device: connect without scanning again
+        cache = self._scan_cache
+        if device_name in cache and time.monotonic() - self._scan_cache_ts < SCAN_CACHE_TTL:
+            return cache[device_name]
+
+        # Stop scanning as soon as the device advertises instead of waiting
+        # for a full discover() timeout
+        found = asyncio.Event()
+        address = None
+        cache.clear()
+        self._scan_cache_ts = time.monotonic()
 
-    async def find_device(self, device_name):
-        devices = await BleakScanner.discover()
-        for device in devices:
+        def detection_callback(device, advertisement_data):
+            nonlocal address
+            if device.name:
+                cache[device.name] = device.address
             if device.name == device_name:
-                return device.address
-        return None
+                address = device.address
+                found.set()
 
-    async def connect_device(self, device_name):
-        try:
-            devices = await BleakScanner.discover()
-            device_address = next((d.address for d in devices if d.name == device_name), None)
-            if device_address:
-                async with BleakClient(device_address) as client:
-                    print(f"Connected to {device_name}")
-                    # Continue with BLE communication logic
-            else:
-                print(f"Device {device_name} not found")
-        except BleakError as e:
-            print(f"An error occurred: {e}")
+        async with BleakScanner(detection_callback=detection_callback):
+            try:
+                await asyncio.wait_for(found.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return address
 
     def on_closing(self):
-        self.executor.shutdown(wait=False)
+        self._closed = True
+        # Disconnect on the loop thread while Tk keeps processing events, then
+        # destroy the window once the loop has stopped or the deadline passed
+        self._shutdown_deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        self.schedule(self._shutdown())
+        self._wait_for_shutdown()
+
+    def _wait_for_shutdown(self):
+        if self.loop.is_running() and time.monotonic() < self._shutdown_deadline:
+            self.after(50, self._wait_for_shutdown)
+            return
+        # No join: the loop thread is a daemon and dies with the process
+        self._call_soon_threadsafe(self.loop.stop)
+        self.after_cancel(self._flush_job)
         self.destroy()
+
+    async def _shutdown(self):
+        try:
+            await asyncio.wait_for(self.disconnect_device(), timeout=SHUTDOWN_TIMEOUT)
+        except (asyncio.TimeoutError, BleakError):
+            pass
+        finally:
+            self.loop.stop()
             
+    async def negotiate_mtu(self, client):
+        # BlueZ only reports the negotiated MTU after it has been acquired explicitly;
+        # the other backends negotiate it while connecting
+        if client._backend.__class__.__name__ == "BleakClientBlueZDBus":
+            try:
+                await client._backend._acquire_mtu()
+            except Exception as e:
+                self.safe_update_text(f"Could not acquire the MTU: {e}\n")
+        return client.mtu_size
+
     async def async_connect_device(self, device_name):
-        address = await self.find_device(device_name)
+        # The address saved with the last device lets a reconnect skip discovery
+        address = self._last_address if device_name == self._last_saved else None
+        if not address:
+            address = await self.find_device(device_name)
         if not address:
-            self.received_data_text.insert(tk.END, f"Device '{device_name}' not found.\n")
+            self.safe_update_text(f"Device '{device_name}' not found.\n")
             return
         
-        self.ble_client = BleakClient(address)
+        self.ble_client = BleakClient(address, disconnected_callback=self._on_ble_disconnect)
         try:
             await self.ble_client.connect()
             if self.ble_client.is_connected:
-                self.received_data_text.insert(tk.END, f"Connected to {device_name}.\n")
-                self.save_last_connected_device(device_name)
-                asyncio.create_task(self.listen_for_notifications())
+                # Pass the characteristic object to writes so Bleak skips the UUID lookup
+                char = self.ble_client.services.get_characteristic(CHARACTERISTIC_WRITE_UUID)
+                if char is not None:
+                    self._write_char = char
+                    self._supports_wwr = "write-without-response" in char.properties
+                # Sends are only accepted once the write mode above is known
+                self._is_connected = True
+                self.safe_update_text(f"Connected to {device_name}.\n")
+                mtu = await self.negotiate_mtu(self.ble_client)
+                self.safe_update_text(f"MTU: {mtu} bytes ({mtu - 3} per write).\n")
+                # Read after the MTU is known: BlueZ derives this size from it
+                self._wwr_limit = char.max_write_without_response_size if char is not None else mtu - 3
+                await self.listen_for_notifications()
         except Exception as e:
-            self.received_data_text.insert(tk.END, f"Failed to connect to {device_name}: {e}\n")
+            # Don't leave a half set-up link accepting sends; cleared first so the
+            # disconnected callback doesn't report it as unexpected
+            self._is_connected = False
+            if self.ble_client.is_connected:
+                try:
+                    await self.ble_client.disconnect()
+                except Exception:
+                    pass
+            # The cached or saved address may be stale, scan again on the next attempt
+            self._scan_cache.pop(device_name, None)
+            self._last_address = None
+            self.safe_update_text(f"Failed to connect to {device_name}: {e}\n")
+            return
+
+        if not self._is_connected:
+            return
+        try:
+            # File I/O runs in the default executor so the loop keeps serving BLE events
+            await asyncio.to_thread(self.save_last_connected_device, device_name, address)
+        except OSError as e:
+            # Only the next start's shortcut is lost, the connection itself is fine
+            self.safe_update_text(f"Could not save the last connected device: {e}\n")
             
+    def _on_ble_disconnect(self, client):
+        # Called by Bleak on the asyncio thread, including when the robot drops the link;
+        # ignore a client that has already been replaced by a newer connection
+        if client is self.ble_client:
+            # disconnect_device clears the flag first, so a set flag means the link was lost
+            if self._is_connected:
+                self.safe_update_text("Device disconnected unexpectedly.\n")
+            self._is_connected = False
+            self._write_char = CHARACTERISTIC_WRITE_UUID
+            self._supports_wwr = False
+            self._wwr_limit = DEFAULT_WWR_SIZE
+
     async def listen_for_notifications(self):
-        def handle_notification(sender, data):
-            self.received_data_text.insert(tk.END, f"Received: {data}\n")
-            self.received_data_text.see(tk.END)
+        # Runs on the asyncio thread; only queues the raw bytes, the Tk-side poll
+        # decodes and inserts them
+        def handle_notification(sender, data, _append=self._pending_rx.append):
+            _append(data)
         
         await self.ble_client.start_notify(CHARACTERISTIC_NOTIFY_UUID, handle_notification)
 
-    def save_last_connected_device(self, device_name):
-        with open("last_connected_device.json", "w") as f:
-            json.dump({"device_name": device_name}, f)
+    def save_last_connected_device(self, device_name, address=None):
+        # Reconnecting to the same device: the file is already up to date
+        if device_name == self._last_saved and address == self._last_address:
+            return
+
+        # Write a temporary file then rename it, so a crash never leaves a torn file
+        tmp_file = DEVICE_FILE + ".tmp"
+        Path(tmp_file).write_text(json.dumps({DEVICE_NAME_KEY: device_name, DEVICE_ADDRESS_KEY: address}),
+                                  encoding="utf-8")
+        os.replace(tmp_file, DEVICE_FILE)
+        self._last_saved = device_name
+        self._last_address = address
 
     
+    def update_end_bytes(self, *args):
+        self._end_bytes = END_DATA_OPTIONS.get(self.line_endings.get(), b'')
+
     def send_message(self):
-        if self.ble_client and self.ble_client.is_connected:
+        if self._is_connected:
+            if self.message_entry._is_placeholder:
+                return
             message = self.message_entry.get()
-            line_ending = self.line_endings.get()
-            end_data = {"NL": "\n", "CR": "\r", "BOTH": "\r\n", "NONE": ""}[line_ending]
-            full_message = (message + end_data).encode("utf-8")
-            asyncio.run(self.ble_client.write_gatt_char(CHARACTERISTIC_WRITE_UUID, full_message))
+            full_message = message.encode("utf-8") + self._end_bytes
+            self._enqueue_tx(full_message)
             self.message_entry.delete(0, tk.END)
         else:
-            self.received_data_text.insert(tk.END, "Not connected to any device.\n")
+            self.safe_update_text("Not connected to any device.\n")
 
     async def disconnect_device(self):
-        if self.ble_client and self.ble_client.is_connected:
-            await self.ble_client.disconnect()
-            self.received_data_text.insert(tk.END, "Disconnected.\n")
+        client = self.ble_client
+        if client is not None and self._is_connected:
+            # Cleared before the await so _on_ble_disconnect sees a requested disconnect
+            self._is_connected = False
+            await client.disconnect()
+            self._write_char = CHARACTERISTIC_WRITE_UUID
+            self._supports_wwr = False
+            self._wwr_limit = DEFAULT_WWR_SIZE
+            self.safe_update_text("Disconnected.\n")
 
 if __name__ == "__main__":
     app = Application()